@@ -12,16 +12,208 @@ import datetime
 import json
 import re
 import os
-import sys
-import csv
-import argparse
+import hashlib
+from pathlib import Path
+import random
+import threading
+import types
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import orjson
+except ImportError:
+    #orjson is optional, the standard library json module is used when it isn't installed
+    orjson = None
 
 BASE_PYWIKIBOT_DIR = 'modules/wikidata/config'
 PATH_TO_WIKIDATA_CONFIGURATION_TEMPLATE = f'{BASE_PYWIKIBOT_DIR}/user-config.tmpl'
 PATH_TO_WIKIDATA_CONFIGURATION_FILE = f'{BASE_PYWIKIBOT_DIR}/user-config.py'
 PATH_TO_WIKIDATA_PASSWORD_TEMPLATE = f'{BASE_PYWIKIBOT_DIR}/user-password.tmpl'
 PATH_TO_WIKIDATA_PASSWORD_FILE = f'{BASE_PYWIKIBOT_DIR}/user-password.py'
+PATH_TO_QID_CACHE = f'{BASE_PYWIKIBOT_DIR}/qid_cache.json'
+#Seconds after which an entry of the QID cache is considered stale and looked up again.
+QID_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
+#Number of accession numbers resolved per SPARQL query when pre-resolving a batch.
+SPARQL_BATCH_SIZE = 500
+#Number of items fetched per wbgetentities request, the API's limit for ids.
+ENTITY_BATCH_SIZE = 50
+EXISTING_ITEMS_QUERY = '''SELECT DISTINCT ?acc ?Qid WHERE {{
+  VALUES ?acc {{ {values} }}
+  ?item p:P217 ?s .
+  ?s ps:P217 ?acc .
+  ?s pq:P195 wd:Q657415 .
+  BIND(SUBSTR(STR(?item), 32) AS ?Qid)
+}}'''
+#Wikidata items (or property/value pairs) used for each CMA artwork type.
+ENTITIES_TYPE = types.MappingProxyType({
+    "Amulets": "Q131557",
+    "Apparatus": "Q39546",
+    "Arms and Armor": "Q598227",
+    "Basketry": "Q201097",
+    "Book Binding": "Q1125338",
+    "Bound Volume": "Q571",
+    "Calligraphy": "Q22669850",
+    "Carpet": "Q163446",
+    "Ceramic": "Q13464614",
+    "Coins": "Q41207",
+    "Cosmetic Objects": "Q223557",
+    "Drawing": "Q93184",
+    "Embroidery": "Q18281",
+    "Enamel": "Q79496108",
+    "Forgery": "Q29541662",
+    "Funerary Equipment": "Q79497835",
+    "Furniture and woodwork": "Q60734095",
+    "Garment": "Q11460",
+    "Glass": "Q13180610",
+    "Glyptic": {"P2079": "Q929254"},
+    "Illumination": "Q8362",
+    "Implements": "Q39546",
+    "Inlays": {"P2079": "Q1281067"},
+    "Ivory": {"P186": "Q82001"},
+    "Jade": "Q60733799",
+    "Jewelry": "Q161439",
+    "Knitting": "Q29048022",
+    "Lace": "Q231250",
+    "Lacquer": "Q368972",
+    "Lamp": "Q368972",
+    "Leather": "Q79504355",
+    "Linoleum Block": "Q22060043",
+    "Lithographic Stone": "",
+    "Manuscript": "Q87167",
+    "Metalwork": "Q29382731",
+    "Miniature": "Q282129",
+    "Miscellaneous": "",
+    "Mixed Media": {"P136": "Q1902763"},
+    "Monotype": "Q22669635",
+    "Mosaic": "Q133067",
+    "Musical Instrument": "Q34379",
+    "Netsuke": "Q543901",
+    "Painting": "Q3305213",
+    "Photograph": "Q125191",
+    "Plaque": "Q4364339",
+    "Plate": "Q57216",
+    "Portfolio": "Q79509036",
+    "Portrait Miniature": "Q282129",
+    "Print": "Q11060274",
+    "Relief": "Q11060274",
+    "Rock crystal": {"P186": "Q2050687"},
+    "Sampler": "Q1513987",
+    "Scarabs": "Q2442735",
+    "Sculpture": "Q860861",
+    "Seals": "Q2474386",
+    "Silver": {"P186": "Q1090"},
+    "Spindle Whorl": "Q2474386",
+    "Stone": {"P186": "Q22731"},
+    "Tapestry": "Q184296",
+    "Textile": "Q28823",
+    "Time-based Media": {"P136": "Q57206278"},
+    "Tool": "Q39546",
+    "Velvet": {"P186": "Q243519"},
+    "Vessels": "Q987767",
+    "Wood": {"P186": "Q287"},
+    "Woodblock": "Q28913685"
+})
+#Whether the entry of an artwork type in ENTITIES_TYPE is a QID to use as 'instance of'
+ENTITIES_TYPE_IS_QID = types.MappingProxyType(
+    {k: isinstance(v, str) and v != '' for k, v in ENTITIES_TYPE.items()})
+#Edit summaries, completed with the accession number of the artwork and a period.
+SUMMARY_IMPORT_PREFIX = 'Importing Cleveland Museum of Art collections to Wikidata: accession number '
+SUMMARY_STATEMENT_PREFIX = 'Synchronizing Wikidata statement with Cleveland Museum of Art data: accession number '
+SUMMARY_LABEL_PREFIX = 'Synchronizing Wikidata label with Cleveland Museum of Art data: accession number '
+SUMMARY_DESCRIPTION_PREFIX = 'Synchronizing Wikidata description with Cleveland Museum of Art data: accession number '
+#Strips the wiki link markup around a QID, e.g. '[[wikidata:Q1234]]' -> 'Q1234'.
+QID_CLEAN_PATTERN = re.compile(r'\W+')
+#A bare item id, e.g. 'Q1234'.
+QID_PATTERN = re.compile(r'Q\d+')
+#Retry settings for requests throttled by wikidata (HTTP 429/503, maxlag, ratelimited).
+MAX_RETRIES = 8
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60
+RETRY_STATUS_CODES = (429, 503)
+
+def backoff_delay(attempt, retry_after=None):
+    '''
+    Number of seconds to wait before retry number attempt (counting from 0).
+
+    A Retry-After header value in seconds is honored when given, otherwise the delay
+    grows exponentially up to BACKOFF_CAP with up to a second of random jitter so that
+    concurrent workers don't retry in lockstep.
+    '''
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            #Retry-After may also be an http date, fall back to exponential backoff
+            pass
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 1)
+
+def json_loads(data):
+    '''
+    Parse a json document, using orjson when it is available
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def snak_key(snak):
+    '''
+    Hashable key identifying a snak, used to compare claims without list scans
+    '''
+    if orjson is not None:
+        return orjson.dumps(snak, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(snak, sort_keys=True, separators=(',', ':'))
+
+def linked_qids(artwork_json):
+    '''
+    QID of the wikidata item already linked in an artwork's external_resources, as a list.
+
+    Returns None, so the artwork's item is looked up on the query service instead,
+    unless exactly one item is linked and its url ends in a valid QID.
+    '''
+    wikidata_urls = artwork_json.get('external_resources', {}).get('wikidata')
+    if not wikidata_urls:
+        return None
+    qids = list(dict.fromkeys(QID_CLEAN_PATTERN.sub('', url.rpartition('/')[2]) for url in wikidata_urls))
+    if len(qids) != 1 or not QID_PATTERN.fullmatch(qids[0]):
+        return None
+    return qids
+
+class TokenBucket():
+    '''
+    Thread safe token bucket used to limit the rate of edits to wikidata.
+
+    Tokens are added at rate tokens per second up to capacity. acquire blocks
+    until a token is available and consumes it.
+    '''
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError('edit rate must be positive, got %r edits per second'%(rate,))
+        if capacity < 1:
+            raise ValueError('edit burst must be at least 1, got %r'%(capacity,))
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Wait for a token and take it
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
 
 class OpenAccessWikiData():
     '''
@@ -33,6 +225,15 @@ class OpenAccessWikiData():
     into the _sync_wikidata_artwork method.
     '''
 
+    _headers = {
+        'User-Agent': 'Wikidata import script (https://paws.wmflabs.org/paws/user/Dominic/edit/CMA/universal_import.py; dominic@byrd-mcdevitt.com)',
+    }
+    #Hashes of the credentials the configuration files have already been written for by
+    #this process. Lets re-instantiation skip all file I/O.
+    _rendered_config_keys = set()
+    #Serializes writes of the QID cache file by all instances in this process.
+    _qid_cache_file_lock = threading.Lock()
+
     def __init__(self, config):
         '''
         Configure wikidata and import the pywikibot module
@@ -51,31 +252,340 @@ class OpenAccessWikiData():
         #are welcome. 
         import pywikibot as __temp_pywikibot
         self.pywikibot = __temp_pywikibot
+        #production
+        self._site = self.pywikibot.Site('wikidata', 'wikidata')
+        ##test
+        ## test doesn't work becaue I think CMA doesn't have the 
+        ## wikidata infrastructure it has on production
+        #self._site = pywikibot.Site('test', 'wikidata')
+        self._repo = self._site.data_repository()
+        #Items that are used as targets for every artwork, created once and shared.
+        self._institution_target = self.pywikibot.ItemPage(self._repo, u'Q657415')
+        self._circum_target = self.pywikibot.ItemPage(self._repo, u'Q5727902')
+        self._lang_target = self.pywikibot.ItemPage(self._repo, u'Q1860')
+        self._instance_target = self.pywikibot.ItemPage(self._repo, u'Q18593264')
+        self._copyrighted_target = self.pywikibot.ItemPage(self._repo, u'Q50423863')
+        self._cc0_target = self.pywikibot.ItemPage(self._repo, u'Q19652')
+        self._determination_target = self.pywikibot.ItemPage(self._repo, u'Q61848113')
+        self._format_target = self.pywikibot.ItemPage(self._repo, u'Q2195')
+        self._license_target = self.pywikibot.ItemPage(self._repo, u'Q6938433')
+        #Maps accession numbers to the QIDs of the Wikidata items carrying them, and to
+        #the time those QIDs were resolved. Both are shared by the worker threads of
+        #batch_sync and guarded by a lock.
+        self._accession_to_qid = {}
+        self._qid_resolved_at = {}
+        self._qid_cache_lock = threading.Lock()
+        #Set when an entry that is persisted to the cache file is added, changed or
+        #dropped, so the file is only rewritten when its content changes.
+        self._qid_cache_dirty = False
+        self._load_qid_cache()
+        #One lock per accession number, held while an artwork's item is looked up and
+        #created, so concurrent syncs of the same accession number can't both create it.
+        self._accession_locks = {}
+        self._accession_locks_lock = threading.Lock()
+        #Items of a batch whose content has been fetched ahead of syncing, keyed by QID.
+        self._entity_cache = {}
+        #pywikibot's Site object is shared by all threads and is not guaranteed to be
+        #thread safe, so every write to wikidata goes through _write and this lock.
+        self._write_lock = threading.Lock()
+        #Edits are spread out by a token bucket shared by all threads, the rate is
+        #given in edits per minute to match wikidata's bot policy.
+        self._bucket = TokenBucket(rate=self.config.get('edit_rate_per_min', 60) / 60.0,
+            capacity=self.config.get('edit_burst', 1))
+        #Number of artworks batch_sync processes concurrently, configurable to stay
+        #within wikidata's edit limits.
+        self._max_workers = self.config.get('max_workers', 8)
+        #Reuse connections to the query service instead of opening a new one per request.
+        #The pool is sized to cover the worker threads of batch_sync.
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=self._max_workers,
+            pool_maxsize=self._max_workers))
 
     def update_wikidata(self, artwork_json):
         '''
         Update a single artwork in wikidata given its json representation
         '''
-        message, item = self._sync_wikidata_artwork(artwork_json)
+        with self._accession_lock(artwork_json.get('accession_number')):
+            message, item = self._sync_wikidata_artwork(artwork_json)
+        self._save_qid_cache()
         return message, item
 
     def batch_sync(self, artwork_json_list):
         '''
         Update a list of artworks in wikidata given their json representations
         '''
-        result_list = []
-        for artwork_json in artwork_json_list:
-            #print(artwork_json["accession_number"])
-            message, item = self._sync_wikidata_artwork(artwork_json)
-            print(message)
-            
-            if item:
-                wikidata_url = 'https://www.wikidata.org/wiki/'+re.sub(r'\W+', '', item.split(':')[1])
-                if wikidata_url not in artwork_json['external_resources']['wikidata']:
-                    artwork_json['external_resources']['wikidata'].append(wikidata_url)
-            result_list.append(artwork_json)
+        #resolve the items of the artworks and of the parent objects of their parts up front,
+        #artworks already linked to their item don't need to be looked up
+        artworks_with_accession_number = [artwork_json for artwork_json in artwork_json_list
+            if artwork_json.get('accession_number')]
+        accession_numbers = [artwork_json['accession_number'] for artwork_json in artworks_with_accession_number
+            if not linked_qids(artwork_json)]
+        parent_accession_numbers = ['.'.join(artwork_json['accession_number'].split('.')[:2])
+            for artwork_json in artworks_with_accession_number
+            if len(artwork_json['accession_number'].split('.')) > 2]
+        #accession numbers found to have no item from here on are trusted for this batch only
+        batch_started_at = time.time()
+        self._resolve_existing_qids(accession_numbers + parent_accession_numbers)
+        #Syncing is bound by HTTP round trips, so artworks are processed concurrently.
+        futures = []
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            #Artworks are processed in chunks of ENTITY_BATCH_SIZE. The items of a chunk are
+            #fetched in one request right before it is synced, so edits are based on
+            #current content rather than content loaded at the start of a long batch.
+            for start in range(0, len(artwork_json_list), ENTITY_BATCH_SIZE):
+                chunk = artwork_json_list[start:start + ENTITY_BATCH_SIZE]
+                self._preload_items(self._known_qids(chunk))
+                chunk_futures = [executor.submit(self._process_one, artwork_json, batch_started_at) for artwork_json in chunk]
+                for future in as_completed(chunk_futures):
+                    artwork_json, message, item = future.result()
+                    print(message)
+                futures.extend(chunk_futures)
+                self._entity_cache.clear()
+        self._save_qid_cache()
+        #keep the results in the order the artworks were given
+        result_list = [future.result()[0] for future in futures]
         return result_list
 
+    def _process_one(self, artwork_json, batch_started_at):
+        '''
+        Sync a single artwork for batch_sync and record its wikidata url in the artwork json.
+
+        Any exception is turned into the returned message, so one failing artwork doesn't
+        abort the batch or discard the results of the others.
+        '''
+        #print(artwork_json["accession_number"])
+        try:
+            with self._accession_lock(artwork_json.get('accession_number')):
+                message, item = self._sync_wikidata_artwork(artwork_json, batch_started_at=batch_started_at)
+        except Exception as e:
+            return artwork_json, "Failed to sync: %s  %r"%(artwork_json.get('accession_number'), e), None
+        if item:
+            wikidata_url = 'https://www.wikidata.org/wiki/' + QID_CLEAN_PATTERN.sub('', item.partition(':')[2])
+            if wikidata_url not in artwork_json['external_resources']['wikidata']:
+                artwork_json['external_resources']['wikidata'].append(wikidata_url)
+        return artwork_json, message, item
+
+    def _accession_lock(self, accession_number):
+        '''
+        Lock serializing the syncs of artworks with the given accession number
+        '''
+        with self._accession_locks_lock:
+            return self._accession_locks.setdefault(accession_number, threading.Lock())
+
+    def _lookup_qid(self, accession_number, batch_started_at=None):
+        '''
+        Return the list of QIDs of the items with the given accession number.
+
+        The cache is consulted first and only accession numbers missing from it are
+        queried. A cached miss (an empty list) is only trusted when it was resolved
+        after batch_started_at, otherwise someone may have created the item since and
+        it is queried again. Returns None when the query service could not be reached.
+        '''
+        with self._qid_cache_lock:
+            qids = self._accession_to_qid.get(accession_number)
+            if qids:
+                return qids
+            if (qids is not None and batch_started_at is not None
+                    and self._qid_resolved_at.get(accession_number, 0) >= batch_started_at):
+                return qids
+        return self._resolve_existing_qids([accession_number]).get(accession_number)
+
+    def _remember_qid(self, accession_number, qid):
+        '''
+        Record the QID of an item created for accession_number in the cache
+        '''
+        with self._qid_cache_lock:
+            if self._accession_to_qid.get(accession_number) != [qid]:
+                self._qid_cache_dirty = True
+            self._accession_to_qid[accession_number] = [qid]
+            self._qid_resolved_at[accession_number] = time.time()
+
+    def _forget_qid(self, accession_number):
+        '''
+        Drop the cached QIDs of accession_number, e.g. when its item was deleted or merged
+        '''
+        with self._qid_cache_lock:
+            if self._accession_to_qid.pop(accession_number, None):
+                self._qid_cache_dirty = True
+            self._qid_resolved_at.pop(accession_number, None)
+
+    def _load_qid_cache(self):
+        '''
+        Read the accession number to QID cache written by a previous run.
+
+        Entries resolved more than the qid_cache_max_age config value (QID_CACHE_MAX_AGE
+        seconds by default) ago are skipped, so they are looked up again, as are entries
+        that aren't of the form {'qids': [...], 'resolved_at': <timestamp>}. Nothing is
+        loaded if the file can't be read.
+        '''
+        max_age = self.config.get('qid_cache_max_age', QID_CACHE_MAX_AGE)
+        try:
+            with open(PATH_TO_QID_CACHE, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(cached, dict):
+            return
+        now = time.time()
+        with self._qid_cache_lock:
+            for acc, entry in cached.items():
+                if not isinstance(entry, dict):
+                    continue
+                qids = entry.get('qids')
+                resolved_at = entry.get('resolved_at')
+                if not isinstance(qids, list) or not all(isinstance(qid, str) for qid in qids):
+                    continue
+                if isinstance(resolved_at, bool) or not isinstance(resolved_at, (int, float)):
+                    continue
+                if now - resolved_at > max_age:
+                    continue
+                self._accession_to_qid[acc] = qids
+                self._qid_resolved_at[acc] = resolved_at
+
+    def _save_qid_cache(self):
+        '''
+        Write the accession numbers that have an item on wikidata to the cache file.
+
+        Accession numbers without an item are not persisted, as an item may be created
+        for them by someone else before the next run. Each entry keeps the time it was
+        resolved, so saving doesn't extend its lifetime. Nothing is written unless an
+        entry changed since the last save. The cache is written to a temporary file
+        that then replaces the old one, so readers never see a partially written file.
+        '''
+        with self._qid_cache_lock:
+            if not self._qid_cache_dirty:
+                return
+            self._qid_cache_dirty = False
+            found = {acc: {'qids': qids, 'resolved_at': self._qid_resolved_at[acc]}
+                for acc, qids in self._accession_to_qid.items() if qids}
+        cache_dir = os.path.dirname(PATH_TO_QID_CACHE) or '.'
+        f = None
+        try:
+            with OpenAccessWikiData._qid_cache_file_lock:
+                with tempfile.NamedTemporaryFile('w', dir=cache_dir, prefix='.qid_cache.', delete=False) as f:
+                    json.dump(found, f)
+                os.replace(f.name, PATH_TO_QID_CACHE)
+        except OSError as e:
+            print('Failed to write QID cache: %s'%(e))
+            if f is not None and os.path.exists(f.name):
+                os.remove(f.name)
+            with self._qid_cache_lock:
+                self._qid_cache_dirty = True
+
+    def _resolve_existing_qids(self, accession_numbers):
+        '''
+        Look up the Wikidata items for many accession numbers at once.
+
+        Rather than issuing one SPARQL request per artwork, the accession numbers are
+        sent in chunks of SPARQL_BATCH_SIZE using a VALUES clause. Accession numbers
+        already known to have an item are skipped. The results are added to the cache
+        and returned as a dict mapping every accession number of a successfully queried
+        chunk to the list of matching QIDs (empty when no item exists yet). Accession
+        numbers from chunks whose query failed are left out.
+        '''
+        with self._qid_cache_lock:
+            accession_numbers = [acc for acc in dict.fromkeys(accession_numbers)
+                if not self._accession_to_qid.get(acc)]
+        accession_to_qid = {}
+        for start in range(0, len(accession_numbers), SPARQL_BATCH_SIZE):
+            chunk = accession_numbers[start:start + SPARQL_BATCH_SIZE]
+            #json.dumps produces a quoted and escaped literal that is also valid SPARQL
+            query = EXISTING_ITEMS_QUERY.format(values=' '.join(json.dumps(acc) for acc in chunk))
+            try:
+                response = self._request_with_backoff('POST', SPARQL_ENDPOINT,
+                    params={'format': 'json'}, data={'query': query})
+                bindings = json_loads(response.content)['results']['bindings']
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print('Failed to pre-resolve %s accession numbers: %s'%(len(chunk), e))
+                continue
+            for acc in chunk:
+                accession_to_qid[acc] = []
+            for binding in bindings:
+                accession_to_qid.setdefault(binding['acc']['value'], []).append(binding['Qid']['value'])
+        now = time.time()
+        with self._qid_cache_lock:
+            if any(self._accession_to_qid.get(acc, []) != qids for acc, qids in accession_to_qid.items()):
+                self._qid_cache_dirty = True
+            self._accession_to_qid.update(accession_to_qid)
+            self._qid_resolved_at.update((acc, now) for acc in accession_to_qid)
+        return accession_to_qid
+
+    def _known_qids(self, artwork_json_list):
+        '''
+        QIDs of the items of the given artworks that are already known, from their link
+        in external_resources or from the QID cache
+        '''
+        qids = []
+        with self._qid_cache_lock:
+            for artwork_json in artwork_json_list:
+                if not artwork_json.get('accession_number'):
+                    continue
+                artwork_qids = linked_qids(artwork_json) or self._accession_to_qid.get(artwork_json['accession_number'])
+                if artwork_qids and len(artwork_qids) == 1:
+                    qids.append(artwork_qids[0])
+        return qids
+
+    def _preload_items(self, qids):
+        '''
+        Load the content of the items with the given QIDs into the entity cache.
+
+        pywikibot's preload_entities fetches labels, descriptions and claims of up to
+        ENTITY_BATCH_SIZE items per wbgetentities request, so syncing the items right
+        after doesn't need a request per item. Items that fail to load are simply fetched
+        when they are synchronized.
+        '''
+        pages = [self.pywikibot.ItemPage(self._repo, qid) for qid in dict.fromkeys(qids)
+            if qid not in self._entity_cache]
+        try:
+            for item in self._repo.preload_entities(pages, groupsize=ENTITY_BATCH_SIZE):
+                self._entity_cache[item.getID()] = item
+        except self.pywikibot.exceptions.Error as e:
+            print('Failed to preload %s items: %s'%(len(pages), e))
+
+    def _request_with_backoff(self, method, url, **kwargs):
+        '''
+        Send a request to the wikidata query service, retrying while it is throttled.
+
+        Responses with a status in RETRY_STATUS_CODES and connection errors are retried
+        up to MAX_RETRIES times, sleeping as given by backoff_delay in between. The last
+        response is returned if the service never recovers.
+        '''
+        kwargs.setdefault('headers', self._headers)
+        kwargs.setdefault('timeout', 30)
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = self._session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                return response
+            time.sleep(backoff_delay(attempt, response.headers.get('Retry-After')))
+
+    def _write(self, write_method, *args, **kwargs):
+        '''
+        Call a pywikibot method that writes to wikidata (editEntity, addClaim, ...).
+
+        Writes are serialized with a lock as pywikibot's Site is shared between the
+        worker threads of batch_sync, and each attempt waits for a token from the
+        edit rate limiter. Writes rejected because of maxlag or rate limiting
+        are retried up to MAX_RETRIES times with exponential backoff.
+        '''
+        for attempt in range(MAX_RETRIES + 1):
+            self._bucket.acquire()
+            try:
+                with self._write_lock:
+                    return write_method(*args, **kwargs)
+            except self.pywikibot.exceptions.MaxlagTimeoutError:
+                if attempt == MAX_RETRIES:
+                    raise
+            except self.pywikibot.exceptions.APIError as e:
+                if e.code != 'ratelimited' or attempt == MAX_RETRIES:
+                    raise
+            time.sleep(backoff_delay(attempt))
+
 
     def _configure_wikidata(self):
         """
@@ -91,59 +601,64 @@ class OpenAccessWikiData():
         #so the pywikibot module knows where to look for configuration information
         #https://www.mediawiki.org/wiki/Manual:Pywikibot/user-config.py
         os.environ['PYWIKIBOT_DIR'] = BASE_PYWIKIBOT_DIR
+        #hashed so the bot password isn't kept around in memory
+        config_key = hashlib.blake2b(json.dumps([self.config.get('username'), self.config.get('bot_username'),
+            self.config.get('bot_password')]).encode()).digest()
+        if config_key in OpenAccessWikiData._rendered_config_keys:
+            return
         #create user-config file
-        config_template = ''
-        with open(PATH_TO_WIKIDATA_CONFIGURATION_TEMPLATE, 'r') as f:
-            config_template = f.read()
+        config_template = Path(PATH_TO_WIKIDATA_CONFIGURATION_TEMPLATE).read_text()
         config_template = config_template.replace('WIKIDATA_USERNAME', self.config.get('username'))
-        #wikidata requires the configuration file to be write only, so we need to set permissions to 
-        #rwx to update file and then afterwords set permissions to r-x to make it not writeable. 
-        if os.path.exists(PATH_TO_WIKIDATA_CONFIGURATION_FILE):
-            os.chmod(PATH_TO_WIKIDATA_CONFIGURATION_FILE, 0o777)
-        else:
-            print('Creating user-config.py file...')
-        with open(PATH_TO_WIKIDATA_CONFIGURATION_FILE, 'w') as f:
-            f.write(config_template)
-        os.chmod(PATH_TO_WIKIDATA_CONFIGURATION_FILE, 0o555)
+        #wikidata requires the configuration file to be write only, so it is made read only
+        #after it has been written.
+        self._update_config_file(PATH_TO_WIKIDATA_CONFIGURATION_FILE, config_template, read_only=True)
         #create user-password file
-        password_template = ''
-        with open(PATH_TO_WIKIDATA_PASSWORD_TEMPLATE, 'r') as f:
-            password_template = f.read()
+        password_template = Path(PATH_TO_WIKIDATA_PASSWORD_TEMPLATE).read_text()
         password_template = password_template.replace('WIKIDATA_USERNAME', self.config.get('username'))
         password_template = password_template.replace('WIKIDATA_BOT_USERNAME', self.config.get('bot_username'))
         password_template = password_template.replace('WIKIDATA_BOT_PASSWORD', self.config.get('bot_password'))
-        if not os.path.exists(PATH_TO_WIKIDATA_PASSWORD_FILE):
-            print('Creating user-password.py file...')
-        with open(PATH_TO_WIKIDATA_PASSWORD_FILE, 'w') as f:
-            f.write(password_template)
+        self._update_config_file(PATH_TO_WIKIDATA_PASSWORD_FILE, password_template, read_only=False)
+        OpenAccessWikiData._rendered_config_keys.add(config_key)
+
+    def _update_config_file(self, path, content, read_only):
+        '''
+        Write content to the configuration file at path unless it already holds it.
+
+        The existing file and the new content are compared by hash, so an unchanged file
+        is neither rewritten nor has its permissions touched. To update a read only file
+        its permissions are set to rwx first and back to r-x afterwards.
+        '''
+        config_file = Path(path)
+        if config_file.exists():
+            existing_hash = hashlib.blake2b(config_file.read_bytes()).digest()
+            if existing_hash == hashlib.blake2b(content.encode()).digest():
+                return
+            if read_only:
+                os.chmod(path, 0o777)
+        else:
+            print('Creating %s file...'%(config_file.name))
+        config_file.write_text(content)
+        if read_only:
+            os.chmod(path, 0o555)
 
 
-    def _sync_wikidata_artwork(self, artwork_json):
+    def _sync_wikidata_artwork(self, artwork_json, precomputed_qids=None, batch_started_at=None):
         '''
         Method for uploading an artwork's json metadata to wikidata.
 
         This method is Dominic Byrd-McDevitt's (dominic@byrd-mcdevitt.com) script modified 
-        to take a single JSON artwork as a parameter.
+        to take a single JSON artwork as a parameter. When precomputed_qids is given
+        (the QIDs already found for the artwork's accession number) the existence
+        check is skipped, otherwise the QIDs are taken from _lookup_qid. batch_started_at
+        is the start of the batch_sync run the artwork is part of, see _lookup_qid.
         '''
-        output = ""
-            
-        headers = {
-            'User-Agent': 'Wikidata import script (https://paws.wmflabs.org/paws/user/Dominic/edit/CMA/universal_import.py; dominic@byrd-mcdevitt.com)',
-        }
-
-        #production
-        is_test = False
-        site = self.pywikibot.Site('wikidata', 'wikidata')
-        ##test
-        ## test doesn't work becaue I think CMA doesn't have the 
-        ## wikidata infrastructure it has on production
-        #is_test = True
-        #site = pywikibot.Site('test', 'wikidata')
-        repo = site.data_repository()
+        output_parts = []
+        repo = self._repo
 
         ## Lookup files on Commons to add. (This code was used for adding links to pre-existing Commons files when Wikidata items were created for the first time. It is preserved in the code in case it is ever necessary again, but should not be used otherwise.)
 
         # def lookup(accession_number):
+        #     import csv
         #     with open('commons_files.csv', 'r') as output:
         #         data = csv.reader(output, delimiter='\t')
         #         images = []
@@ -173,10 +688,6 @@ class OpenAccessWikiData():
         license_prop = self.pywikibot.Claim(repo, u'P275')
         type_prop = self.pywikibot.Claim(repo, u'P31')
         created_prop = self.pywikibot.Claim(repo, u'P571')
-        image_prop1 = self.pywikibot.Claim(repo, u'P18')
-        image_prop2 = self.pywikibot.Claim(repo, u'P18')
-        image_prop3 = self.pywikibot.Claim(repo, u'P18')
-        image_props = [image_prop1, image_prop2, image_prop1]
         author_string_prop = self.pywikibot.Claim(repo, u'P2093')
         commons_prop = self.pywikibot.Claim(repo, u'P4765')
         author_string_qual = self.pywikibot.Claim(repo, u'P2093')
@@ -200,9 +711,6 @@ class OpenAccessWikiData():
         license_prop.addSources([url_qual, retrieved_qual])
         type_prop.addSources([url_qual, retrieved_qual])
         created_prop.addSources([url_qual, retrieved_qual])
-        image_prop1.addSources([url_qual, retrieved_qual])
-        image_prop2.addSources([url_qual, retrieved_qual])
-        image_prop3.addSources([url_qual, retrieved_qual])
         author_string_prop.addSources([url_qual, retrieved_qual])
         commons_prop.addQualifier(author_string_qual)
         commons_prop.addQualifier(title_qual)
@@ -220,26 +728,29 @@ class OpenAccessWikiData():
 
         # Parsing data from CMA into statements.
         
-        institution_target = self.pywikibot.ItemPage(repo, u'Q657415')
+        institution_target = self._institution_target
         #this line fails on the test server...
         institution_prop.setTarget(institution_target)
         claims.append(institution_prop)
         #print(artwork)
         
         # pre-populated as CMA
-        location_target = self.pywikibot.ItemPage(repo, u'Q657415')
+        location_target = self._institution_target
         location_prop.setTarget(location_target)
         claims.append(location_prop)
         
         # just the circa
-        circum_target = self.pywikibot.ItemPage(repo, u'Q5727902')
-        circum_qual.setTarget(circum_target)
+        circum_qual.setTarget(self._circum_target)
         
-        lang_target = self.pywikibot.ItemPage(repo, u'Q1860')
-        lang_qual.setTarget(lang_target)
+        lang_qual.setTarget(self._lang_target)
         
         try:
             accession_number = artwork['accession_number']
+            #edit summaries used for every edit made for this artwork
+            summary_import = SUMMARY_IMPORT_PREFIX + accession_number + '.'
+            summary_statement = SUMMARY_STATEMENT_PREFIX + accession_number + '.'
+            summary_label = SUMMARY_LABEL_PREFIX + accession_number + '.'
+            summary_description = SUMMARY_DESCRIPTION_PREFIX + accession_number + '.'
             #print(str(counter) + ': ' + accession_number)
 
             accession_number_prop.setTarget(accession_number)
@@ -248,21 +759,16 @@ class OpenAccessWikiData():
             claims.append(accession_number_prop)
             if len(accession_number.split('.')) > 2:
                 
-                checkparent = requests.get('https://query.wikidata.org/sparql?query=SELECT%20DISTINCT%20%3FQid%20WHERE%20%7B%0A%20%20%3Fitem%20p%3AP217%20%3Fs%20.%0A%20%20%3Fs%20ps%3AP217%20"' + accession_number.split('.')[0] + '.' + accession_number.split('.')[1] + '".%0A%20%20%3Fs%20pq%3AP195%20wd%3AQ657415%20.%0A%20%20BIND%28SUBSTR%28STR%28%3Fitem%29%2C%2032%20%29%20AS%20%3FQid%29%0A%7D &format=json', headers=headers).text
-
-                try:
-                    parent = json.loads(checkparent)
-                    if len(parent['results']['bindings']) == 1:
-                        part_target = self.pywikibot.ItemPage(repo, parent['results']['bindings'][0]['Qid']['value'])
-                        part_prop.setTarget(part_target)
-                        claims.append(part_prop)
-                except:
-                    pass
+                parent_qids = self._lookup_qid(accession_number.split('.')[0] + '.' + accession_number.split('.')[1],
+                    batch_started_at)
+                if parent_qids and len(parent_qids) == 1:
+                    part_target = self.pywikibot.ItemPage(repo, parent_qids[0])
+                    part_prop.setTarget(part_target)
+                    claims.append(part_prop)
                     
         except KeyError as e:
             #print("ERROR %s"%(e))
-            output += e
-            return output
+            return f"{''.join(output_parts)}KeyError: {e!s}", None
 
         url_qual.setTarget(artwork['url'])
 
@@ -272,8 +778,7 @@ class OpenAccessWikiData():
         retrieved_qual_target = self.pywikibot.WbTime(year=now.year, month=now.month, day=now.day)
         retrieved_qual.setTarget(retrieved_qual_target)
         title = artwork['title'].rstrip().lstrip().replace('\n', ' ').replace('\r', ' ')
-        instance_target = self.pywikibot.ItemPage(repo, u'Q18593264')
-        instance_prop.setTarget(instance_target)
+        instance_prop.setTarget(self._instance_target)
         claims.append(instance_prop)
 
         title_target = self.pywikibot.WbMonolingualText(title, 'en')
@@ -285,6 +790,9 @@ class OpenAccessWikiData():
 
     ##             Historical code about adding Wikimedia Commons file links.
     #             files = lookup(accession_number)
+    #             image_props = [pywikibot.Claim(repo, u'P18') for _ in range(3)]
+    #             for image_prop in image_props:
+    #                 image_prop.addSources([url_qual, retrieved_qual])
     #             if len(files) > 0:
     #                 n = 0
     #                 for commons_file in files[0:2]:
@@ -318,25 +826,17 @@ class OpenAccessWikiData():
                 created_prop.addQualifier(circum_qual)
                 claims.append(created_prop)
             
-        author_target = 'unknown artist'
-        if len(artwork['creators']) > 0:
-            author_target = ''
-            for author in artwork['creators']:
-                if author['description']:
-                    author_target = author_target + ' ' + author['description'].replace('\n', ' ') + ';' 
-            author_target = author_target[:-1].lstrip()
+        author_target = '; '.join(author['description'].replace('\n', ' ').strip()
+            for author in artwork['creators'] if author.get('description'))
         if len(author_target) == 0:
             author_target = 'unknown artist'
         
         if artwork['share_license_status'] == 'Copyrighted':
-            copyright_target = self.pywikibot.ItemPage(repo, u'Q50423863')
-            copyright_prop.setTarget(copyright_target)            
+            copyright_prop.setTarget(self._copyrighted_target)            
         if artwork['share_license_status'] == 'CC0':
-            copyright_target = self.pywikibot.ItemPage(repo, u'Q19652')
-            copyright_prop.setTarget(copyright_target)
+            copyright_prop.setTarget(self._cc0_target)
 
-        determination_target = self.pywikibot.ItemPage(repo, u'Q61848113')
-        determination_qual.setTarget(determination_target)
+        determination_qual.setTarget(self._determination_target)
         try:
             copyright_prop.addQualifier(determination_qual)
         except:
@@ -344,92 +844,20 @@ class OpenAccessWikiData():
         if artwork['share_license_status'] == 'Copyrighted' or artwork['share_license_status'] == 'CC0':
             claims.append(copyright_prop)
 
-        entities = {
-                    "type": {
-                        "Amulets": "Q131557",
-                        "Apparatus": "Q39546",
-                        "Arms and Armor": "Q598227",
-                        "Basketry": "Q201097",
-                        "Book Binding": "Q1125338",
-                        "Bound Volume": "Q571",
-                        "Calligraphy": "Q22669850",
-                        "Carpet": "Q163446",
-                        "Ceramic": "Q13464614",
-                        "Coins": "Q41207",
-                        "Cosmetic Objects": "Q223557",
-                        "Drawing": "Q93184",
-                        "Embroidery": "Q18281",
-                        "Enamel": "Q79496108",
-                        "Forgery": "Q29541662",
-                        "Funerary Equipment": "Q79497835",
-                        "Furniture and woodwork": "Q60734095",
-                        "Garment": "Q11460",
-                        "Glass": "Q13180610",
-                        "Glyptic": {"P2079": "Q929254"},
-                        "Illumination": "Q8362",
-                        "Implements": "Q39546",
-                        "Inlays": {"P2079": "Q1281067"},
-                        "Ivory": {"P186": "Q82001"},
-                        "Jade": "Q60733799",
-                        "Jewelry": "Q161439",
-                        "Knitting": "Q29048022",
-                        "Lace": "Q231250",
-                        "Lacquer": "Q368972",
-                        "Lamp": "Q368972",
-                        "Leather": "Q79504355",
-                        "Linoleum Block": "Q22060043",
-                        "Lithographic Stone": "",
-                        "Manuscript": "Q87167",
-                        "Metalwork": "Q29382731",
-                        "Miniature": "Q282129",
-                        "Miscellaneous": "",
-                        "Mixed Media": {"P136": "Q1902763"},
-                        "Monotype": "Q22669635",
-                        "Mosaic": "Q133067",
-                        "Musical Instrument": "Q34379",
-                        "Netsuke": "Q543901",
-                        "Painting": "Q3305213",
-                        "Photograph": "Q125191",
-                        "Plaque": "Q4364339",
-                        "Plate": "Q57216",
-                        "Portfolio": "Q79509036",
-                        "Portrait Miniature": "Q282129",
-                        "Print": "Q11060274",
-                        "Relief": "Q11060274",
-                        "Rock crystal": {"P186": "Q2050687"},
-                        "Sampler": "Q1513987",
-                        "Scarabs": "Q2442735",
-                        "Sculpture": "Q860861",
-                        "Seals": "Q2474386",
-                        "Silver": {"P186": "Q1090"},
-                        "Spindle Whorl": "Q2474386",
-                        "Stone": {"P186": "Q22731"},
-                        "Tapestry": "Q184296",
-                        "Textile": "Q28823",
-                        "Time-based Media": {"P136": "Q57206278"},
-                        "Tool": "Q39546",
-                        "Velvet": {"P186": "Q243519"},
-                        "Vessels": "Q987767",
-                        "Wood": {"P186": "Q287"},
-                        "Woodblock": "Q28913685"
-                        }
-                    }
-
-        if isinstance(entities['type'][artwork['type']], str):
-            if entities['type'][artwork['type']] != '':
-                type_target = self.pywikibot.ItemPage(repo, entities['type'][artwork['type']])
-                type_prop.setTarget(type_target)
-                claims.append(type_prop)
-                claims.remove(instance_prop) # if there's a type field, don't include 'instance of'
+        if ENTITIES_TYPE_IS_QID.get(artwork['type']):
+            type_target = self.pywikibot.ItemPage(repo, ENTITIES_TYPE[artwork['type']])
+            type_prop.setTarget(type_target)
+            claims.append(type_prop)
+            claims.remove(instance_prop) # if there's a type field, don't include 'instance of'
 
         if artwork['share_license_status'] == 'CC0':
             if artwork.get('images'):
                 commons_prop.setTarget(artwork['images']['print']['url'])
                 image_url_qual.setTarget(url_target)
                 author_string_qual.setTarget(author_target)
-                format_qual.setTarget(self.pywikibot.ItemPage(repo, u'Q2195'))
+                format_qual.setTarget(self._format_target)
                 title_qual.setTarget(title_target)
-                license_qual.setTarget(self.pywikibot.ItemPage(repo, u'Q6938433'))
+                license_qual.setTarget(self._license_target)
                 operator_qual.setTarget(institution_target)
                     
         if len(title) > 250:
@@ -446,6 +874,9 @@ class OpenAccessWikiData():
         claimlist = []
         for claim in claims:
             claimlist.append(claim.toJSON())
+        #the commons link is created together with the item rather than in a second edit
+        if commons_prop.getTarget() is not None:
+            claimlist.append(commons_prop.toJSON())
         data = {'labels': {'en': label}, 'descriptions': {'en': description}, 'claims': claimlist}
         items.append((data, accession_number, label))
         item_return = None
@@ -453,13 +884,16 @@ class OpenAccessWikiData():
             
     # Check for existing item.
 
-            getcheck = requests.get('https://query.wikidata.org/sparql?query=SELECT%20DISTINCT%20%3FQid%20WHERE%20%7B%0A%20%20%3Fitem%20p%3AP217%20%3Fs%20.%0A%20%20%3Fs%20ps%3AP217%20"' + accession_number + '".%0A%20%20%3Fs%20pq%3AP195%20wd%3AQ657415%20.%0A%20%20BIND%28SUBSTR%28STR%28%3Fitem%29%2C%2032%20%29%20AS%20%3FQid%29%0A%7D &format=json', headers=headers).text
-
-            try:
-                check = json.loads(getcheck)
-            except:
-                #print(getcheck)
-                return None
+            if precomputed_qids is None:
+                #a linked item that turns out to be deleted or merged is handled like a stale
+                #cache entry below
+                precomputed_qids = linked_qids(artwork_json)
+            if precomputed_qids is None:
+                precomputed_qids = self._lookup_qid(accession_number, batch_started_at)
+                if precomputed_qids is None:
+                    output_parts.append("Failed to check for existing item: %s"%(accession_number))
+                    return ''.join(output_parts), None
+            check = {'results': {'bindings': [{'Qid': {'value': qid}} for qid in precomputed_qids]}}
 
     # If no item with this accession number, create it.
         
@@ -467,43 +901,52 @@ class OpenAccessWikiData():
 
                 #print(message)
                 try:
-                    item.editEntity(newitem, summary='Importing Cleveland Museum of Art collections to Wikidata: accession number ' + accession_number + '.')
-                    time.sleep(10)
-                    try:
-                        item.addClaim(commons_prop, summary='Synchronizing Wikidata statement with Cleveland Museum of Art data: accession number ' + accession_number + '.')
-                        message = "Uploaded: %s Item: %s"%(accession_number,str(item))
-                        output += message
-                        #print(str(item) + ': ' + label)
-                        item_return = str(item)
-                    except AttributeError as e:
-                        message = "Failed to upload: %s  %s"%(accession_number, e)
-                        message_explanation = "\n\tMost likely %s has a null image response field in artwork JSON"%(accession_number)
-                        output += (message+message_explanation)
-
-                        pass
+                    self._write(item.editEntity, newitem, summary=summary_import)
+                    self._remember_qid(accession_number, item.getID())
+                    message = "Uploaded: %s Item: %s"%(accession_number,str(item))
+                    output_parts.append(message)
+                    #print(str(item) + ': ' + label)
+                    item_return = str(item)
                 except self.pywikibot.exceptions.OtherPageSaveError as e:
                     message = "Failed to upload: %s  %s"%(accession_number, e)
-                    output += message 
+                    output_parts.append(message)
                     pass
                 
     # If item found with this accession number, detect changes and synchronize any missing data.
                 
             if len(check['results']['bindings']) == 1:
-                item = self.pywikibot.ItemPage(repo, check['results']['bindings'][0]['Qid']['value'])
-                getclaims = item.get()['claims']
+                qid = check['results']['bindings'][0]['Qid']['value']
+                #items preloaded by batch_sync are used once, later syncs fetch them again
+                item = self._entity_cache.pop(qid, None)
+                if item is None:
+                    item = self.pywikibot.ItemPage(repo, qid)
+                #fetch and serialize the item once, the same content is used for all checks below
+                try:
+                    entity = item.get()
+                except (self.pywikibot.exceptions.NoPageError, self.pywikibot.exceptions.IsRedirectPageError):
+                    #the cached or linked QID belongs to a deleted or merged item, look the
+                    #accession number up again and sync against the item found now
+                    self._forget_qid(accession_number)
+                    fresh_qids = self._lookup_qid(accession_number)
+                    if fresh_qids is None or qid in fresh_qids:
+                        output_parts.append("Item %s of %s is missing or a redirect"%(qid, accession_number))
+                        return ''.join(output_parts), None
+                    return self._sync_wikidata_artwork(artwork_json, precomputed_qids=fresh_qids,
+                        batch_started_at=batch_started_at)
+                entity_json_claims = item.toJSON()['claims']
                 message = "syncing: %s label: %s"%(accession_number, str(item))
-                output += message
+                output_parts.append(message)
                 item_return = str(item)
                 #print(message)
                 try:
-                    if item.get()['labels']['en'] != label:
-                        item.editLabels(labels={'en': label }, summary='Synchronizing Wikidata label with Cleveland Museum of Art data: accession number ' + accession_number + '.')
-                        output += '\n\tSynchronizing changes to label for ' + str(item) + ': ' + label
+                    if entity['labels']['en'] != label:
+                        self._write(item.editLabels, labels={'en': label }, summary=summary_label)
+                        output_parts.append('\n\tSynchronizing changes to label for ' + str(item) + ': ' + label)
                         #print('Synchronizing changes to label for ' + str(item) + ': ' + label)
                 except:
-                    if not item.get()['labels'].get('en'):
-                        item.editLabels(labels={'en': label }, summary='Synchronizing Wikidata label with Cleveland Museum of Art data: accession number ' + accession_number + '.')
-                        output += '\n\tSynchronizing changes to label for ' + str(item) + ': ' + label
+                    if not entity['labels'].get('en'):
+                        self._write(item.editLabels, labels={'en': label }, summary=summary_label)
+                        output_parts.append('\n\tSynchronizing changes to label for ' + str(item) + ': ' + label)
                         #print('Synchronizing changes to label for ' + str(item) + ': ' + label)
 #                 try:
 #                 if item.get()['descriptions']['en'] != description:
@@ -514,37 +957,38 @@ class OpenAccessWikiData():
 
                 # don't edit description if there already is one
                 # add accession number to description if label + description pair isn't unique
-                if not item.get()['descriptions'].get('en'):
+                if not entity['descriptions'].get('en'):
                     try:
-                        item.editDescriptions(descriptions={'en': description }, summary='Synchronizing Wikidata description with Cleveland Museum of Art data: accession number ' + accession_number + '.')
+                        self._write(item.editDescriptions, descriptions={'en': description }, summary=summary_description)
 #                             print('Synchronizing changes to description for ' + str(item) + ': ' + label)
                     except:
-                        item.editDescriptions(descriptions={'en': description + '(' + accession_number + ')' }, summary='Synchronizing Wikidata description with Cleveland Museum of Art data: accession number ' + accession_number + '.')
+                        self._write(item.editDescriptions, descriptions={'en': description + '(' + accession_number + ')' }, summary=summary_description)
 #                             print('Synchronizing changes to description for ' + str(item) + ': ' + label)
 
-                clms = []
-                for prop in item.get()['claims']:
-                    for clm in item.toJSON()['claims'][prop]:
-                        clm.pop('id', None)
-                        if not clm['mainsnak'] in clms:
-                            clms.append(clm['mainsnak'])
+                #keys of the main snaks already on the item, see snak_key
+                seen = set()
+                for prop, prop_claims in entity_json_claims.items():
+                    for clm in prop_claims:
+                        seen.add(snak_key(clm['mainsnak']))
                             
+                #missing claims are collected and added to the item in a single edit
+                new_claims = []
+                new_claims_output = []
                 if artwork['share_license_status'] == 'CC0':
                     if artwork.get('images'):
-                        if 'P18' not in item.get()['claims'].keys():
-                            if 'P4765' not in item.get()['claims'].keys():
-                                try:
-                                    item.addClaim(commons_prop, summary='Synchronizing Wikidata statement with Cleveland Museum of Art data: accession number ' + accession_number + '.')
-                                    output += '\n\tSynchronizing missing \'P4765\' claim for ' + str(item) + ': ' + label
-                                    #print('Synchronizing missing \'P4765\' claim for ' + str(item) + ': ' + label)
-                                except AttributeError as e:
-                                    output += '\n\tFailed to synchronize claim %s'%(e)
-                                    pass
+                        if 'P18' not in entity['claims']:
+                            if 'P4765' not in entity['claims'] and commons_prop.getTarget() is not None:
+                                new_claims.append(commons_prop.toJSON())
+                                new_claims_output.append('\n\tSynchronizing missing \'P4765\' claim for ' + str(item) + ': ' + label)
+                                #print('Synchronizing missing \'P4765\' claim for ' + str(item) + ': ' + label)
                             
                 for stmnt in claims:
 
                     stmnt_compare = stmnt.toJSON()
-                    if not stmnt_compare['mainsnak'] in clms:
+                    stmnt_key = snak_key(stmnt_compare['mainsnak'])
+                    if stmnt_key not in seen:
+                        #a statement can be in claims twice (e.g. created_prop), only add it once
+                        seen.add(stmnt_key)
                         if item.claims.get(stmnt_compare['mainsnak']['property']):
                             for p in item.claims[stmnt_compare['mainsnak']['property']]:
                                 if p.toJSON().get('references'):
@@ -552,10 +996,13 @@ class OpenAccessWikiData():
                                         if(ref['snaks'].get('P854')):
                                             for url in ref['snaks']['P854']:
                                                 if url['datavalue']['value'] == 'https://clevelandart.org/art/' + accession_number:
-                                                    item.removeClaims(p, summary=u'Removing outdated statement.')
-                                                    output += '\n\tRemoving outdated \'' + str(stmnt.toJSON()['mainsnak']['property'])  + '\' claim for ' + str(item) + ': ' + label
-                        item.addClaim(stmnt, summary='Synchronizing Wikidata statement with Cleveland Museum of Art data: accession number ' + accession_number + '.')
-                        output += '\n\tSynchronizing \'' + str(stmnt.toJSON()['mainsnak']['property'])  + '\' claim for ' + str(item) + ': ' + label
+                                                    self._write(item.removeClaims, p, summary=u'Removing outdated statement.')
+                                                    output_parts.append('\n\tRemoving outdated \'' + str(stmnt.toJSON()['mainsnak']['property'])  + '\' claim for ' + str(item) + ': ' + label)
+                        new_claims.append(stmnt_compare)
+                        new_claims_output.append('\n\tSynchronizing \'' + str(stmnt_compare['mainsnak']['property'])  + '\' claim for ' + str(item) + ': ' + label)
                         #print('Synchronizing \'' + str(stmnt.toJSON()['mainsnak']['property'])  + '\' claim for ' + str(item) + ': ' + label)
+                if new_claims:
+                    self._write(item.editEntity, {'claims': new_claims}, summary=summary_statement)
+                    output_parts.extend(new_claims_output)
         
-        return output, item_return
+        return ''.join(output_parts), item_return
@@ -0,0 +1,14 @@
+'''
+Shared setup for the tests of the OpenAccessWikiData interface.
+
+pytest imports the package's __init__.py itself while setting up the tests, before any
+fixture runs, so requests has to be importable by then. When it isn't installed a mock
+is registered for the session; the tests replace it with their own through monkeypatch.
+'''
+import importlib.util
+import sys
+from unittest import mock
+
+if importlib.util.find_spec('requests') is None:
+    sys.modules.setdefault('requests', mock.MagicMock())
+    sys.modules.setdefault('requests.adapters', mock.MagicMock())
@@ -0,0 +1,104 @@
+'''
+Tests for the OpenAccessWikiData interface that don't need network access.
+
+pywikibot and requests are replaced by mocks in sys.modules before the module is
+loaded, and the configuration and cache files are written to a temporary directory.
+See conftest.py for the stub needed while pytest collects the package itself.
+'''
+import importlib.util
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+
+CONFIG = {'username': 'user', 'bot_username': 'bot', 'bot_password': 'password'}
+
+
+@pytest.fixture
+def module(monkeypatch, tmp_path):
+    for name in ('pywikibot', 'requests', 'requests.adapters'):
+        monkeypatch.setitem(sys.modules, name, mock.MagicMock())
+    spec = importlib.util.spec_from_file_location('wikidata', PACKAGE_DIR / '__init__.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for template in ('user-config.tmpl', 'user-password.tmpl'):
+        shutil.copy(PACKAGE_DIR / 'config' / template, tmp_path / template)
+    monkeypatch.setattr(module, 'BASE_PYWIKIBOT_DIR', str(tmp_path))
+    monkeypatch.setattr(module, 'PATH_TO_WIKIDATA_CONFIGURATION_TEMPLATE', str(tmp_path / 'user-config.tmpl'))
+    monkeypatch.setattr(module, 'PATH_TO_WIKIDATA_CONFIGURATION_FILE', str(tmp_path / 'user-config.py'))
+    monkeypatch.setattr(module, 'PATH_TO_WIKIDATA_PASSWORD_TEMPLATE', str(tmp_path / 'user-password.tmpl'))
+    monkeypatch.setattr(module, 'PATH_TO_WIKIDATA_PASSWORD_FILE', str(tmp_path / 'user-password.py'))
+    monkeypatch.setattr(module, 'PATH_TO_QID_CACHE', str(tmp_path / 'qid_cache.json'))
+    monkeypatch.setenv('PYWIKIBOT_DIR', str(tmp_path))
+    return module
+
+
+@pytest.fixture
+def wikidata(module):
+    return module.OpenAccessWikiData(CONFIG)
+
+
+def test_update_wikidata_reports_missing_accession_number(wikidata):
+    message, item = wikidata.update_wikidata({'url': 'https://clevelandart.org/art/1', 'title': 'Title'})
+    assert (message, item) == ("KeyError: 'accession_number'", None)
+
+
+@pytest.mark.parametrize('urls, expected', [
+    (['https://www.wikidata.org/wiki/Q123'], ['Q123']),
+    (['https://www.wikidata.org/wiki/Q123', 'https://www.wikidata.org/wiki/Q123'], ['Q123']),
+    (['https://www.wikidata.org/wiki/Q123', 'https://www.wikidata.org/wiki/Q456'], None),
+    (['https://www.wikidata.org/wiki/'], None),
+    (['https://www.wikidata.org/wiki/Q123#P217'], None),
+    ([], None),
+])
+def test_linked_qids(module, urls, expected):
+    assert module.linked_qids({'external_resources': {'wikidata': urls}}) == expected
+
+
+def test_linked_qids_without_external_resources(module):
+    assert module.linked_qids({'accession_number': '1916.1'}) is None
+
+
+def test_qid_cache_round_trip(module, wikidata):
+    wikidata._remember_qid('1916.1', 'Q123')
+    wikidata._accession_to_qid['1916.2'] = []
+    wikidata._qid_resolved_at['1916.2'] = time.time()
+    wikidata._save_qid_cache()
+    reloaded = module.OpenAccessWikiData(CONFIG)
+    assert reloaded._accession_to_qid == {'1916.1': ['Q123']}
+    assert reloaded._qid_resolved_at['1916.1'] == wikidata._qid_resolved_at['1916.1']
+
+
+def test_qid_cache_is_only_written_when_changed(module, wikidata):
+    wikidata._save_qid_cache()
+    assert not Path(module.PATH_TO_QID_CACHE).exists()
+    wikidata._remember_qid('1916.1', 'Q123')
+    wikidata._save_qid_cache()
+    Path(module.PATH_TO_QID_CACHE).unlink()
+    wikidata._save_qid_cache()
+    assert not Path(module.PATH_TO_QID_CACHE).exists()
+
+
+def test_load_qid_cache_skips_invalid_and_stale_entries(module):
+    now = time.time()
+    Path(module.PATH_TO_QID_CACHE).write_text(json.dumps({
+        '1916.1': {'resolved_at': now},
+        '1916.2': {'qids': ['Q2'], 'resolved_at': 'yesterday'},
+        '1916.3': ['Q3'],
+        '1916.4': {'qids': ['Q4'], 'resolved_at': now - module.QID_CACHE_MAX_AGE - 1},
+        '1916.5': {'qids': ['Q5'], 'resolved_at': now},
+    }))
+    wikidata = module.OpenAccessWikiData(CONFIG)
+    assert wikidata._accession_to_qid == {'1916.5': ['Q5']}
+
+
+@pytest.mark.parametrize('rate, capacity', [(0, 1), (-1, 1), (1, 0)])
+def test_token_bucket_rejects_invalid_settings(module, rate, capacity):
+    with pytest.raises(ValueError):
+        module.TokenBucket(rate, capacity)